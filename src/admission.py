@@ -0,0 +1,150 @@
+"""Per-route-class admission control for the heavy (model) routes.
+
+Each heavy route class gets a fixed number of concurrent slots and a bounded
+wait queue. A request that finds the queue full, or waits longer than the
+class allows, is turned away straight away with 503 and a Retry-After
+header instead of piling up behind multi-second model loads. A heavy class
+can never occupy more threads than its slots plus its queue.
+
+There is no priority scheduling. Light routes (login/home and the internal
+/api calls the heavy routes depend on) are never queued. They only do
+better because the heavy classes are capped below the worker's thread count
+(gunicorn_config.threads), which leaves threads free for them. Their latency
+is recorded so you can check that it stays flat under load.
+
+Limits apply per worker process; stats are exposed per process as well.
+"""
+import functools
+import os
+import threading
+import time
+from collections import deque
+
+import numpy as np
+from flask import request, g, jsonify, make_response
+
+
+class RouteClass:
+    def __init__(self, name, max_concurrent, max_queue, max_wait, retry_after):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.max_wait = max_wait
+        self.retry_after = retry_after
+        self.in_flight = 0
+        self.queued = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.timed_out = 0
+        self.wait_times = deque(maxlen=1000)
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        start = time.monotonic()
+        with self._cond:
+            # Only take a free slot directly if nobody is already waiting for one
+            if self.in_flight < self.max_concurrent and self.queued == 0:
+                return self._admit(start)
+            if self.queued >= self.max_queue:
+                self.rejected += 1
+                return False
+            self.queued += 1
+            deadline = start + self.max_wait
+            try:
+                while self.in_flight >= self.max_concurrent:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.timed_out += 1
+                        return False
+                    self._cond.wait(remaining)
+            finally:
+                self.queued -= 1
+            return self._admit(start)
+
+    def _admit(self, start):
+        self.in_flight += 1
+        self.admitted += 1
+        self.wait_times.append(time.monotonic() - start)
+        return True
+
+    def release(self):
+        with self._cond:
+            self.in_flight -= 1
+            self._cond.notify()
+
+    def stats(self):
+        with self._cond:
+            wait_times = np.array(self.wait_times)
+            return {
+                'max_concurrent': self.max_concurrent,
+                'max_queue': self.max_queue,
+                'in_flight': self.in_flight,
+                'queued': self.queued,
+                'admitted': self.admitted,
+                'rejected': self.rejected,
+                'timed_out': self.timed_out,
+                'wait_ms': latency_summary(wait_times),
+            }
+
+
+def latency_summary(seconds):
+    if len(seconds) == 0:
+        return {'p50': None, 'p99': None, 'max': None}
+    p50, p99 = np.percentile(seconds, [50, 99]) * 1000
+    return {'p50': round(p50, 1), 'p99': round(p99, 1), 'max': round(seconds.max() * 1000, 1)}
+
+
+class AdmissionController:
+    def __init__(self, app=None):
+        self.classes = {}
+        self.light_latencies = deque(maxlen=1000)
+        self._light_lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def add_class(self, name, max_concurrent, max_queue, max_wait, retry_after):
+        self.classes[name] = RouteClass(name, max_concurrent, max_queue, max_wait, retry_after)
+
+    def init_app(self, app):
+        app.before_request(self._start_timer)
+        app.after_request(self._record_light)
+
+    def _start_timer(self):
+        g.admission_start = time.monotonic()
+
+    def _record_light(self, response):
+        if 'admission_start' in g and 'admission_class' not in g:
+            with self._light_lock:
+                self.light_latencies.append(time.monotonic() - g.admission_start)
+        return response
+
+    def limit(self, class_name, methods=None):
+        """Run the decorated view under class_name's limits (only for the given methods, if any)."""
+        def decorator(view):
+            @functools.wraps(view)
+            def wrapper(*args, **kwargs):
+                if methods is not None and request.method not in methods:
+                    return view(*args, **kwargs)
+                route_class = self.classes[class_name]
+                g.admission_class = class_name
+                if not route_class.acquire():
+                    return self.reject(route_class)
+                try:
+                    return view(*args, **kwargs)
+                finally:
+                    route_class.release()
+            return wrapper
+        return decorator
+
+    def reject(self, route_class):
+        response = make_response(jsonify({'message' : 'Server is busy, please try again shortly.'}), 503)
+        response.headers['Retry-After'] = str(route_class.retry_after)
+        return response
+
+    def stats(self):
+        with self._light_lock:
+            light_latencies = np.array(self.light_latencies)
+        data = {name: route_class.stats() for name, route_class in self.classes.items()}
+        data['light'] = {'requests': len(light_latencies), 'latency_ms': latency_summary(light_latencies)}
+        data['pid'] = os.getpid()
+        return data
@@ -1,4 +1,4 @@
-from flask import Flask, render_template, request, redirect, url_for, session, flash, make_response, jsonify, Response
+from flask import Flask, render_template, request, redirect, url_for, session, flash, make_response, jsonify, Response, stream_with_context, abort
 from flask_mysqldb import MySQL
 from werkzeug.utils import secure_filename
 import MySQLdb.cursors
@@ -9,11 +9,19 @@ import requests
 import re
 import os
 import io
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
 from openpyxl import Workbook
 from base64 import b64encode, b64decode
 from PIL import Image
 from keras import backend as K
 import tensorflow as tf
+import tempfile
+import threading
+from collections import OrderedDict
+from model_registry import LocalDirectoryBackend, ModelRegistry
+from hard_mining import HardPairSampler
+from admission import AdmissionController
 
 app = Flask(__name__)
 
@@ -45,6 +53,25 @@ mysql = MySQL(app)
 UPLOAD_FOLDER = os.path.join(app_dir,'static','uploads')
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 
+# Trained weights live in a registry shared by every app node (point MODEL_REGISTRY_DIR at a shared mount)
+MODEL_REGISTRY_DIR = os.environ.get('MODEL_REGISTRY_DIR', os.path.join(app_dir,'static','models','registry'))
+MODEL_CACHE_DIR = os.environ.get('MODEL_CACHE_DIR', os.path.join(app_dir,'static','models','cache'))
+MODEL_CACHE_SIZE = int(os.environ.get('MODEL_CACHE_SIZE', 4))
+model_registry = ModelRegistry(LocalDirectoryBackend(MODEL_REGISTRY_DIR), MODEL_CACHE_DIR)
+
+# Concurrency limits for the model routes: slots, wait queue length, max wait (s), Retry-After (s)
+admission = AdmissionController(app)
+admission.add_class('inference', 
+                    max_concurrent=int(os.environ.get('INFERENCE_MAX_CONCURRENT', 2)), 
+                    max_queue=int(os.environ.get('INFERENCE_MAX_QUEUE', 4)), 
+                    max_wait=float(os.environ.get('INFERENCE_MAX_WAIT', 20)), 
+                    retry_after=int(os.environ.get('INFERENCE_RETRY_AFTER', 5)))
+admission.add_class('training', 
+                    max_concurrent=int(os.environ.get('TRAINING_MAX_CONCURRENT', 1)), 
+                    max_queue=int(os.environ.get('TRAINING_MAX_QUEUE', 0)), 
+                    max_wait=float(os.environ.get('TRAINING_MAX_WAIT', 0)), 
+                    retry_after=int(os.environ.get('TRAINING_RETRY_AFTER', 60)))
+
 
 def allowed_file(filename):
     ALLOWED_EXTENSIONS = set(['png', 'jpg', 'jpeg', 'gif'])
@@ -58,9 +85,16 @@ def contrastive_loss(y_true, y_pred):
     return K.mean(y_true * K.square(y_pred) + (1 - y_true) * K.square(K.maximum(margin - y_pred, 0)))
 
 class Image_Preprocessing:
-    def __init__(self, img_height, img_width):
+    def __init__(self, img_height, img_width, n_workers=None, cache_size=0):
         self.img_height = img_height
         self.img_width = img_width
+        self.n_workers = n_workers or min(8, (os.cpu_count() or 1) + 2)
+        # Created up front: img_pre is shared by all request threads
+        self._executor = ThreadPoolExecutor(max_workers=self.n_workers)
+        # Preprocessed images keyed by signature content hash, most recently used last
+        self.cache_size = cache_size
+        self._cache = OrderedDict()
+        self._cache_lock = threading.Lock()
     
     def processing(self, image):
         # Resize image -> Grayscale conversion -> Normalization
@@ -70,12 +104,105 @@ class Image_Preprocessing:
         image = image / 255.0
         return image[..., np.newaxis]
     
+    def open(self, fp):
+        # JPEG draft mode lets the decoder scale down (1/2, 1/4, 1/8) and emit
+        # grayscale directly, so we never decode the full-size scan
+        image = Image.open(fp)
+        image.draft('L', (self.img_width, self.img_height))
+        return image
+    
+    def processing_into(self, image, out):
+        # Same steps as processing(), but normalize straight into out (h, w, 1)
+        image = image.resize((self.img_width, self.img_height))
+        image = image.convert('L')
+        np.divide(np.asarray(image), 255.0, out=out[..., 0], dtype='float32')
+        return out
+    
     def imread(self, path):
-        image = Image.open(path)
+        image = self.open(path)
         image = self.processing(image)
         return image
-
-img_pre = Image_Preprocessing(155, 220)
+    
+    def _cache_get(self, key):
+        with self._cache_lock:
+            image = self._cache.get(key)
+            if image is not None:
+                self._cache.move_to_end(key)
+            return image
+
+    def _cache_put(self, key, image):
+        with self._cache_lock:
+            self._cache[key] = image
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    def imread_batch(self, buffers, out=None, keys=None):
+        # Decode many encoded images (bytes) in parallel into one float32 batch.
+        # PIL releases the GIL while decoding and resizing, so threads scale.
+        # keys (content hashes, None where unknown) let repeated images skip decoding.
+        n_images = len(buffers)
+        shape = (n_images, self.img_height, self.img_width, 1)
+        if out is None:
+            out = np.empty(shape, dtype='float32')
+        elif out.shape != shape or out.dtype != np.float32:
+            raise ValueError(f"out must be a float32 array of shape {shape}, got {out.dtype} {out.shape}")
+
+        def load(i):
+            key = keys[i] if keys is not None and self.cache_size else None
+            if not isinstance(key, str):
+                # Rows stored before content hashing have no key
+                key = None
+            cached = self._cache_get(key) if key is not None else None
+            if cached is not None:
+                out[i] = cached
+                return
+            self.processing_into(self.open(io.BytesIO(buffers[i])), out[i])
+            if key is not None:
+                self._cache_put(key, out[i].copy())
+
+        # list() re-raises the first decoding error, if any
+        list(self._executor.map(load, range(n_images)))
+        return out
+
+# PREPROCESS_WORKERS sizes the decode thread pool (0 = min(8, cpu_count + 2))
+img_pre = Image_Preprocessing(155, 220, n_workers=int(os.environ.get('PREPROCESS_WORKERS', 0)) or None, 
+                              cache_size=int(os.environ.get('PREPROCESS_CACHE_SIZE', 512)))
+
+# Uploads within this many differing bits of an existing signature's perceptual hash count as duplicates (0 = exact only)
+NEAR_DUPLICATE_DISTANCE = int(os.environ.get('NEAR_DUPLICATE_DISTANCE', 0))
+
+def content_hash(image_bytes):
+    return hashlib.sha256(image_bytes).hexdigest()
+
+def perceptual_hash(image_bytes):
+    # 64-bit difference hash of the normalized 155x220 grayscale signature
+    try:
+        image = img_pre.imread(io.BytesIO(image_bytes))
+    except Exception:
+        return None
+    image = Image.fromarray(np.uint8(image[..., 0] * 255)).resize((9, 8), Image.BILINEAR)
+    pixels = np.asarray(image, dtype='int16')
+    bits = (pixels[:, 1:] > pixels[:, :-1]).flatten()
+    return int(sum(1 << i for i, bit in enumerate(bits) if bit))
+
+def hamming_distance(hash_1, hash_2):
+    return bin(hash_1 ^ hash_2).count('1')
+
+def find_duplicate_signature(cursor, account_id, sha256, phash):
+    # Return the signature_id of an existing exact (or near) duplicate for this account, if any
+    cursor.execute('SELECT signature_id FROM signatures WHERE account_id = %s AND content_hash = %s LIMIT 1', 
+                   (account_id, sha256))
+    row = cursor.fetchone()
+    if row:
+        return row['signature_id']
+    if NEAR_DUPLICATE_DISTANCE and phash is not None:
+        cursor.execute('SELECT signature_id, perceptual_hash FROM signatures WHERE account_id = %s AND perceptual_hash IS NOT NULL', 
+                       (account_id,))
+        for row in cursor.fetchall():
+            if hamming_distance(phash, row['perceptual_hash']) <= NEAR_DUPLICATE_DISTANCE:
+                return row['signature_id']
+    return None
 
 def get_batch(batch_size, room_id):
     response = requests.get(f"{my_url}/api/signatures/room/{room_id}")
@@ -87,13 +214,13 @@ def get_batch(batch_size, room_id):
     n_signers = len(signers_id)
     categories = rng.choice(n_signers, size=(batch_size,), replace=False)
 
-    #initialize 2 empty arrays for the input image batch
-    pairs=[np.zeros((batch_size, img_pre.img_height, img_pre.img_width, 1)) for i in range(2)]
-
     #initialize vector for the targets, and make one half of it '1's, so 2nd half of batch has same class
     targets=np.zeros((batch_size,))
     targets[batch_size//2:] = 1
 
+    #encoded images for both sides of the pairs: first batch_size are the left images, rest the right ones
+    buffers = [None] * (2 * batch_size)
+    keys = [None] * (2 * batch_size)
     for i in range(batch_size):
         category_1 = categories[i]
 
@@ -107,22 +234,171 @@ def get_batch(batch_size, room_id):
         images_1 = df[df['id'] == signers_id[category_1]]['signature_image']
         images_2 = df[df['id'] == signers_id[category_2]]['signature_image']
 
-        rand_image_1 = img_pre.imread(io.BytesIO(b64decode(rng.choice(images_1))))
-        rand_image_2 = img_pre.imread(io.BytesIO(b64decode(rng.choice(images_2))))
+        row_1 = rng.choice(images_1.index)
+        row_2 = rng.choice(images_2.index)
+        buffers[i] = b64decode(df.at[row_1, 'signature_image'])
+        buffers[batch_size + i] = b64decode(df.at[row_2, 'signature_image'])
+        keys[i] = df.at[row_1, 'content_hash']
+        keys[batch_size + i] = df.at[row_2, 'content_hash']
 
-        pairs[0][i,:,:,:] = rand_image_1
-        pairs[1][i,:,:,:] = rand_image_2
+    #decode everything in one parallel pass into a single preallocated float32 array
+    images = img_pre.imread_batch(buffers, keys=keys)
+    pairs = [images[:batch_size], images[batch_size:]]
     return pairs, targets
 
-def get_model(room_id):
-    response = requests.get(f"{my_url}/api/models/{room_id}")
-    model_data = response.json()
-    model_path = os.path.join(app_dir,'static','models', model_data['model_name']+".h5")
+# Training schedule: iterations per batch slot, and the opt-in hard pair sampler (see hard_mining.py)
+TRAIN_ITER_PER_SIGNER = int(os.environ.get('TRAIN_ITER_PER_SIGNER', 50))
+HARD_MINING = os.environ.get('HARD_MINING', '0') == '1'
+HARD_NEGATIVE_RATIO = float(os.environ.get('HARD_NEGATIVE_RATIO', 0.5))
+HARD_POSITIVE_RATIO = float(os.environ.get('HARD_POSITIVE_RATIO', 0.5))
+HARD_MINING_REFRESH = int(os.environ.get('HARD_MINING_REFRESH', 10))
+
+# Pairs scoring below this distance are taken as the same signer
+VERIFICATION_THRESHOLD = 0.35
+
+# room_id -> (weights key, model), most recently used last
+loaded_models = OrderedDict()
+loaded_models_lock = threading.Lock()
+
+# One lock per room: a cached Keras model is shared by the request threads of a
+# gthread worker, so loading it and calling predict on it are serialized per room
+room_locks = {}
+room_locks_lock = threading.Lock()
+
+def room_lock(room_id):
+    with room_locks_lock:
+        return room_locks.setdefault(room_id, threading.Lock())
+
+def load_model_weights(weights_path):
     custom_objects = {"contrastive_loss": contrastive_loss, 'K':K}
     model = tf.keras.models.load_model(os.path.join(app_dir,'default_model.h5'), custom_objects)
-    model.load_weights(model_path)
+    model.load_weights(weights_path)
     return model
 
+def get_model(room_id, cached=True):
+    # Resolve the newest registry version; rooms that were never trained
+    # (or were trained before the registry existed) use the local file named in the models table
+    version = model_registry.latest(room_id)
+    if version is not None:
+        weights_key = version['sha256']
+        model_path = None
+    else:
+        response = requests.get(f"{my_url}/api/models/{room_id}")
+        model_data = response.json()
+        weights_key = model_data['model_name']
+        model_path = os.path.join(app_dir,'static','models', weights_key+".h5")
+
+    if not cached:
+        # Caller will mutate the model (training), keep it out of the shared cache
+        return load_model_weights(model_path or model_registry.fetch(version))
+
+    # Holding the room lock means concurrent misses load the weights once
+    with room_lock(room_id):
+        with loaded_models_lock:
+            entry = loaded_models.get(room_id)
+            if entry is not None and entry[0] == weights_key:
+                loaded_models.move_to_end(room_id)
+                return entry[1]
+
+        model = load_model_weights(model_path or model_registry.fetch(version))
+        with loaded_models_lock:
+            loaded_models[room_id] = (weights_key, model)
+            loaded_models.move_to_end(room_id)
+            while len(loaded_models) > MODEL_CACHE_SIZE:
+                loaded_models.popitem(last=False)
+        return model
+
+def publish_model(room_id, model, metadata=None):
+    # Save to a temp .h5 (the suffix selects the format), then hand it to the registry
+    fd, weights_path = tempfile.mkstemp(suffix='.h5')
+    os.close(fd)
+    try:
+        model.save_weights(weights_path)
+        return model_registry.publish(room_id, weights_path, metadata)
+    finally:
+        os.remove(weights_path)
+
+
+# Largest page a listing returns, and largest cursor (the key columns are signed INT)
+MAX_PAGE_SIZE = int(os.environ.get('MAX_PAGE_SIZE', 1000))
+MAX_CURSOR = 2**31 - 1
+
+def page_param(name, minimum, maximum):
+    # ASCII integer query parameter in [minimum, maximum], or None when absent; anything else is a 400
+    value = request.args.get(name)
+    if value is None:
+        return None
+    if not (value.isascii() and value.isdigit()) or not minimum <= int(value) <= maximum:
+        abort(make_response(jsonify({'message' : f'{name} must be an integer from {minimum} to {maximum}'}), 400))
+    return int(value)
+
+def page_clause(key, params):
+    # Optional keyset pagination: ?limit=N&cursor=<last key seen>; the next page starts after the last item's key
+    limit = page_param('limit', 1, MAX_PAGE_SIZE)
+    after = page_param('cursor', 0, MAX_CURSOR)
+    clause = ''
+    if after is not None:
+        clause += f' AND {key} > %s'
+        params.append(after)
+    clause += f' ORDER BY {key}'
+    if limit is not None:
+        clause += ' LIMIT %s'
+        params.append(limit)
+    return clause
+
+def stream_rows(query, params, to_item=dict, fetch_size=100):
+    # Unbuffered server-side cursor: rows are pulled from MySQL and written out as a JSON array
+    # a few at a time, so neither the result set nor the serialized body is ever held in full
+    cursor = mysql.connection.cursor(MySQLdb.cursors.SSDictCursor)
+    cursor.execute(query, params)
+
+    def generate():
+        try:
+            yield '['
+            separator = ''
+            while True:
+                rows = cursor.fetchmany(fetch_size)
+                if not rows:
+                    break
+                for row in rows:
+                    yield separator + app.json.dumps(to_item(row))
+                    separator = ','
+            yield ']'
+        finally:
+            cursor.close()
+
+    return Response(stream_with_context(generate()), status=200, mimetype='application/json')
+
+# Schema additions the API below depends on, applied once per process on the first request
+SIGNATURE_HASHES_MIGRATION = os.path.join(app_dir, 'migrations', '001_signature_hashes.sql')
+signature_schema_ready = False
+signature_schema_lock = threading.Lock()
+
+def has_signature_hash_columns(cursor):
+    cursor.execute("SHOW COLUMNS FROM signatures LIKE 'content_hash'")
+    return cursor.fetchone() is not None
+
+def add_signature_hash_columns(cursor):
+    with open(SIGNATURE_HASHES_MIGRATION) as f:
+        migration = f.read()
+    try:
+        cursor.execute(migration)
+    except MySQLdb.OperationalError as e:
+        # 1060 duplicate column: another worker applied it first
+        if e.args[0] != 1060:
+            raise
+
+@app.before_request
+def ensure_signature_schema():
+    global signature_schema_ready
+    if signature_schema_ready:
+        return
+    with signature_schema_lock:
+        if not signature_schema_ready:
+            cursor = mysql.connection.cursor()
+            if not has_signature_hash_columns(cursor):
+                add_signature_hash_columns(cursor)
+            signature_schema_ready = True
 
 #============================== API Accounts ==============================#
 @app.route('/api/accounts/<id>', methods=['GET'])
@@ -176,53 +452,52 @@ def change_account(id):
 #============================== API Signatures ==============================#
 @app.route('/api/signatures/<account_id>', methods=['GET'])
 def take_signatures(account_id):
-    cursor = mysql.connection.cursor(MySQLdb.cursors.DictCursor)
-    cursor.execute('SELECT signature_id, signature_image FROM signatures WHERE account_id = %s', (account_id,))
-    signatures = cursor.fetchall()
-    data = []
-    for row in signatures:
-        id = row['signature_id']
-        image = row['signature_image']
-        image = b64encode(image).decode('utf-8')
-        data.append({'signature_id' : id, 'signature_image' : image})
-    return make_response(jsonify(data), 200)
+    params = [account_id]
+    query = 'SELECT signature_id, signature_image FROM signatures WHERE account_id = %s' + page_clause('signature_id', params)
+    return stream_rows(query, params, lambda row: {'signature_id' : row['signature_id'], 
+                                                 'signature_image' : b64encode(row['signature_image']).decode('utf-8')})
 
 @app.route('/api/signatures/room/<room_id>', methods=['GET'])
 def take_signatures_by_room(room_id):
-    cursor = mysql.connection.cursor(MySQLdb.cursors.DictCursor)
-    cursor.execute("""SELECT signature_image, id
+    params = [room_id]
+    query = """SELECT signature_id, signature_image, id, content_hash
     FROM signatures AS sig, accounts AS a, join_rooms AS jr, rooms AS r
-    WHERE sig.account_id = a.id AND a.id = jr.account_id AND jr.room_id = r.room_id AND r.room_id = %s""", (room_id,))
-    signatures = cursor.fetchall()
-    data = []
-    for row in signatures:
-        id = row['id']
-        image = row['signature_image']
-        image = b64encode(image).decode('utf-8')
-        data.append({'signature_image' : image, 'id' : id})
-    return make_response(jsonify(data), 200)
+    WHERE sig.account_id = a.id AND a.id = jr.account_id AND jr.room_id = r.room_id AND r.room_id = %s""" + page_clause('sig.signature_id', params)
+    return stream_rows(query, params, lambda row: {'signature_image' : b64encode(row['signature_image']).decode('utf-8'), 
+                                                 'id' : row['id'], 'content_hash' : row['content_hash'], 
+                                                 'signature_id' : row['signature_id']})
 
 @app.route('/api/signatures/std_id/<string:std_id>', methods=['GET'])
 def take_signatures_by_std_id(std_id):
-    cursor = mysql.connection.cursor(MySQLdb.cursors.DictCursor)
-    cursor.execute("""SELECT signature_image FROM signatures, accounts WHERE std_id = %s AND account_id = id""", (std_id,))
-    signatures = cursor.fetchall()
-    data = []
-    for row in signatures:
-        image = row['signature_image']
-        image = b64encode(image).decode('utf-8')
-        data.append({'signature_image' : image})
-    return make_response(jsonify(data), 200)
+    params = [std_id]
+    query = """SELECT signature_id, signature_image, content_hash FROM signatures, accounts 
+    WHERE std_id = %s AND account_id = id""" + page_clause('signature_id', params)
+    return stream_rows(query, params, lambda row: {'signature_image' : b64encode(row['signature_image']).decode('utf-8'), 
+                                                 'content_hash' : row['content_hash'], 
+                                                 'signature_id' : row['signature_id']})
 
 @app.route('/api/signatures/', methods=['POST'])
 def add_signature():
     data = request.get_json()
     image = b64decode(bytes(data['signature_image'], 'utf-8'))
+    sha256 = content_hash(image)
+    phash = perceptual_hash(image)
     cursor = mysql.connection.cursor(MySQLdb.cursors.DictCursor)
-    cursor.execute('INSERT INTO signatures (signature_image, account_id) VALUES (%s, %s)', 
-                   (image, data['account_id']))
-    mysql.connection.commit()
-    return make_response(jsonify({'message' : 'Upload image successfully!'}), 201)
+    duplicate_id = find_duplicate_signature(cursor, data['account_id'], sha256, phash)
+    if duplicate_id is not None:
+        return make_response(jsonify({'message' : 'This image has already been uploaded!', 'signature_id' : duplicate_id}), 200)
+    try:
+        cursor.execute('INSERT INTO signatures (signature_image, account_id, content_hash, perceptual_hash) VALUES (%s, %s, %s, %s)', 
+                       (image, data['account_id'], sha256, phash))
+        mysql.connection.commit()
+    except MySQLdb.IntegrityError:
+        # A concurrent upload of the same file won the unique (account_id, content_hash) index: link to it
+        mysql.connection.rollback()
+        duplicate_id = find_duplicate_signature(cursor, data['account_id'], sha256, None)
+        if duplicate_id is None:
+            raise
+        return make_response(jsonify({'message' : 'This image has already been uploaded!', 'signature_id' : duplicate_id}), 200)
+    return make_response(jsonify({'message' : 'Upload image successfully!', 'signature_id' : cursor.lastrowid}), 201)
 
 @app.route('/api/signatures/<signature_id>', methods=['DELETE'])
 def erase_signature(signature_id):
@@ -297,13 +572,12 @@ def erase_room(room_id):
 #============================== API Join_rooms ==============================#
 @app.route('/api/join_rooms/<room_id>', methods=['GET'])
 def take_join_rooms(room_id):
-    cursor = mysql.connection.cursor(MySQLdb.cursors.DictCursor)
-    cursor.execute("""
+    params = [room_id]
+    query = """
     SELECT id, std_id, fname, lname, check_status, join_room_id
     FROM accounts AS a, join_rooms AS jr, rooms AS r 
-    WHERE id = jr.account_id AND jr.room_id = r.room_id AND r.room_id = %s""", (room_id,))
-    join_rooms = cursor.fetchall()
-    return make_response(jsonify(join_rooms), 200)
+    WHERE id = jr.account_id AND jr.room_id = r.room_id AND r.room_id = %s""" + page_clause('join_room_id', params)
+    return stream_rows(query, params)
 
 @app.route('/api/join_rooms/<room_id>/<account_id>', methods=['GET'])
 def take_join_rooms_by_account(room_id, account_id):
@@ -367,6 +641,11 @@ def change_model(room_id):
     mysql.connection.commit()
     return make_response(jsonify({'message' : 'Train model successfully!'}), 200)
 
+#============================== API Admission ==============================#
+@app.route('/api/admission/', methods=['GET'])
+def take_admission_stats():
+    return make_response(jsonify(admission.stats()), 200)
+
 #============================== APP ==============================#
 @app.route('/', methods=['GET', 'POST'])
 def login():
@@ -568,8 +847,12 @@ def deleteRoom(room_id):
         model_data = response.json()
         model_name = model_data['model_name']
         if model_name != 'signet_model':
+            model_registry.delete_room(room_id)
             model_path = os.path.join(app_dir,'static','models', model_name+".h5")
-            os.remove(model_path)
+            if os.path.exists(model_path):
+                os.remove(model_path)
+        with loaded_models_lock:
+            loaded_models.pop(room_id, None)
         response = requests.delete(f"{my_url}/api/rooms/{room_id}")
         return redirect(url_for('manageroom'))
 
@@ -641,22 +924,32 @@ def leaveroom(room_id):
 
 # Train model in room
 @app.route('/home/room/trainmodel/<room_id>', methods=['POST', 'GET'])
+@admission.limit('training')
 def trainmodel(room_id):
     if 'loggedin' in session:
         response = requests.get(f"{my_url}/api/join_rooms/{room_id}")
         acc_join = response.json()
         df = pd.DataFrame(acc_join)
         batch_size = int(np.ceil(df.shape[0]*0.75))
-        n_iter = 50*batch_size
-        model = get_model(room_id)
+        n_iter = TRAIN_ITER_PER_SIGNER*batch_size
+        model = get_model(room_id, cached=False)
 
-        for i in range(1, n_iter+1):
-            inputs, targets = get_batch(batch_size, room_id)
-            loss = model.train_on_batch(inputs, targets)
+        if HARD_MINING:
+            # Opt-in: fetch the room's signatures once and let the sampler mine pairs with the model being trained
+            response = requests.get(f"{my_url}/api/signatures/room/{room_id}")
+            sampler = HardPairSampler(pd.DataFrame(response.json()), img_pre, 
+                                      hard_negative_ratio=HARD_NEGATIVE_RATIO, hard_positive_ratio=HARD_POSITIVE_RATIO, 
+                                      refresh_every=HARD_MINING_REFRESH)
+            for i in range(1, n_iter+1):
+                inputs, targets = sampler.get_batch(batch_size, model)
+                loss = model.train_on_batch(inputs, targets)
+        else:
+            for i in range(1, n_iter+1):
+                inputs, targets = get_batch(batch_size, room_id)
+                loss = model.train_on_batch(inputs, targets)
         
         new_model_name = f"model_room_{room_id}"
-        new_model_path = os.path.join(app_dir,'static','models', new_model_name+".h5")
-        model.save_weights(new_model_path)
+        publish_model(room_id, model)
 
         data = {
             'model_name' : new_model_name,
@@ -668,6 +961,7 @@ def trainmodel(room_id):
 
 #============================== Function in Scope ==============================#
 @app.route('/home/room/recognition/<room_id>', methods=['POST', 'GET'])
+@admission.limit('inference', methods=['POST'])
 def predict_recognition(room_id):
     if request.method == 'GET':
         response = requests.get(f"{my_url}/api/rooms/{room_id}")
@@ -690,19 +984,22 @@ def predict_recognition(room_id):
             signers_id = df['id'].unique()
             n_signers = len(signers_id)
 
-            support_set = []
+            support_buffers = []
+            support_keys = []
             for category in range(n_signers):
-                support_images = df[df['id'] == signers_id[category]]['signature_image']
-                support_image = img_pre.imread(io.BytesIO(b64decode(rng.choice(support_images))))
-                support_set.append(support_image)
+                support_rows = df[df['id'] == signers_id[category]].index
+                row = rng.choice(support_rows)
+                support_buffers.append(b64decode(df.at[row, 'signature_image']))
+                support_keys.append(df.at[row, 'content_hash'])
             
-            main_set = np.asarray([image]*n_signers)
-            support_set = np.stack(support_set)
+            main_set = np.repeat(image[np.newaxis], n_signers, axis=0)
+            support_set = img_pre.imread_batch(support_buffers, keys=support_keys)
             pairs = [main_set, support_set]
 
             model = get_model(room_id)
 
-            scores = model.predict(pairs)
+            with room_lock(room_id):
+                scores = model.predict(pairs)
             scores = np.array(scores)*10
             probs = np.exp(-scores) / np.sum(np.exp(-scores))
 
@@ -723,6 +1020,7 @@ def predict_recognition(room_id):
             return redirect(url_for('predict_recognition', room_id=room_id))
 
 @app.route('/home/room/verification/<room_id>', methods=['POST', 'GET'])
+@admission.limit('inference', methods=['POST'])
 def predict_verification(room_id):
     if request.method == 'GET':
         response = requests.get(f"{my_url}/api/join_rooms/{room_id}/{session['id']}")
@@ -752,22 +1050,20 @@ def predict_verification(room_id):
                 inforoom = response.json()
                 return render_template('verification.html', inforoom=inforoom)
 
-            support_set = []
             support_images = df['signature_image']
             n_support_images = len(support_images)
-
-            for support_image in support_images:
-                support_set.append(img_pre.imread(io.BytesIO(b64decode(support_image))))
+            support_buffers = [b64decode(support_image) for support_image in support_images]
+            support_keys = list(df['content_hash'])
             
-            main_set = np.asarray([image]*n_support_images)
-            support_set = np.stack(support_set)
+            main_set = np.repeat(image[np.newaxis], n_support_images, axis=0)
+            support_set = img_pre.imread_batch(support_buffers, keys=support_keys)
             pairs = [main_set, support_set]
 
             model = get_model(room_id)
-            threshold = 0.35
             
-            scores = model.predict(pairs)
-            target_pred = np.where(scores < threshold, 1, 0).reshape(-1)
+            with room_lock(room_id):
+                scores = model.predict(pairs)
+            target_pred = np.where(scores < VERIFICATION_THRESHOLD, 1, 0).reshape(-1)
             target_pred = pd.Series(target_pred)
             most_target_pred = target_pred.mode().values[0]
 
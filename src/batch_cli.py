@@ -0,0 +1,353 @@
+"""Offline training and evaluation of room models.
+
+Usage:
+    python batch_cli.py train [--rooms ID ...] [--jobs 2] [--threads 2] [--exclude-holdout] [--evaluate] [--report out.json]
+    python batch_cli.py evaluate [--rooms ID ...] [--jobs 2] [--threads 2] [--top-k 3] [--impostors 5] [--allow-in-sample]
+                                 [--report out.json] [--baseline old.json] [--tolerance 0.05]
+
+Talks to the same database (the app's environment variables) and model
+registry as the web app, without going through the HTTP API. ``train``
+retrains the given rooms, or every room whose model is still untrained,
+and publishes the new weights exactly like /home/room/trainmodel. Each
+room runs in its own process, with at most --jobs processes. Each process
+gets --threads TensorFlow intra-op threads, --threads inter-op threads and
+--threads image decoding threads.
+
+``evaluate`` holds out the most recent signature of every signer with at
+least two and uses it as a query against the rest of the room:
+
+- recognition top-1/top-k: one random support signature per signer, ranked
+  by distance, as in predict_recognition
+- verification FAR/FRR at VERIFICATION_THRESHOLD: majority vote over all
+  support signatures of the claimed signer, as in predict_verification.
+  Genuine claims use the query's own signer; impostor claims use up to
+  --impostors other signers
+- pairs scored per second by model.predict
+
+These numbers only mean something if the model never saw the queries.
+``train --exclude-holdout`` (implied by ``train --evaluate``) trains without
+them and records their signature ids with the published version; evaluate
+uses exactly those ids as queries. Rooms whose current weights did not
+exclude a holdout set (trained through /home/room/trainmodel, or without
+the flag) are skipped, unless --allow-in-sample is given, in which case
+they are evaluated on the newest signatures, flagged in_sample and left out
+of the baseline comparison. Every report entry records excludes_holdout.
+
+With --baseline, rooms whose top-1, FAR, FRR or pairs/s got worse than the
+baseline report by more than --tolerance are listed and the command exits
+with status 1.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime, timezone
+
+import numpy as np
+import numpy.random as rng
+import pandas as pd
+
+
+def set_thread_budget(threads, seed):
+    # Runs in each job process before app is imported, so img_pre's decode pool
+    # is sized from the budget too, not just TensorFlow
+    os.environ['PREPROCESS_WORKERS'] = str(threads)
+    import tensorflow as tf
+    tf.config.threading.set_intra_op_parallelism_threads(threads)
+    tf.config.threading.set_inter_op_parallelism_threads(threads)
+    rng.seed(seed)
+
+
+def query(sql, args=()):
+    import MySQLdb.cursors
+    from app import mysql
+    cursor = mysql.connection.cursor(MySQLdb.cursors.DictCursor)
+    cursor.execute(sql, args)
+    return cursor.fetchall()
+
+
+def untrained_rooms():
+    return [row['room_id'] for row in query("SELECT room_id FROM models WHERE train_status = 'untrained'")]
+
+
+def all_rooms():
+    return [row['room_id'] for row in query('SELECT room_id FROM models')]
+
+
+def room_signatures(room_id):
+    # Raw BLOBs, streamed from an unbuffered cursor: no buffered result set and no
+    # base64 copies, and HardPairSampler/imread_batch take the bytes as they are
+    import MySQLdb.cursors
+    from app import mysql
+    cursor = mysql.connection.cursor(MySQLdb.cursors.SSDictCursor)
+    try:
+        cursor.execute("""SELECT signature_id, signature_image, id, content_hash
+        FROM signatures AS sig, accounts AS a, join_rooms AS jr, rooms AS r
+        WHERE sig.account_id = a.id AND a.id = jr.account_id AND jr.room_id = r.room_id AND r.room_id = %s
+        ORDER BY sig.signature_id""", (room_id,))
+        return pd.DataFrame(list(cursor), columns=['signature_id', 'id', 'content_hash', 'signature_image'])
+    finally:
+        cursor.close()
+
+
+def holdout_split(df):
+    # The newest signature of every signer that has at least two is held out
+    is_latest = df['signature_id'] == df.groupby('id')['signature_id'].transform('max')
+    has_support = df.groupby('id')['id'].transform('size') > 1
+    holdout = is_latest & has_support
+    return df[~holdout].reset_index(drop=True), df[holdout].reset_index(drop=True)
+
+
+def load_room_model(room_id, version=None):
+    # Returns the model and its registry version (None for weights from before the registry).
+    # Pass version to load exactly the one whose metadata was already checked.
+    from app import app_dir, model_registry, load_model_weights
+    version = version or model_registry.latest(str(room_id))
+    if version is not None:
+        return load_model_weights(model_registry.fetch(version)), version
+    model_name = query('SELECT model_name FROM models WHERE room_id = %s', (room_id,))[0]['model_name']
+    return load_model_weights(os.path.join(app_dir, 'static', 'models', model_name + ".h5")), None
+
+
+def holdout_ids(version):
+    # Signature ids the version's weights were trained without, or None if it did not exclude any
+    metadata = (version or {}).get('metadata') or {}
+    return metadata.get('holdout_signature_ids') if metadata.get('excludes_holdout') else None
+
+
+def train_room(room_id, options):
+    from app import (app, mysql, img_pre, publish_model, TRAIN_ITER_PER_SIGNER, HARD_MINING,
+                     HARD_NEGATIVE_RATIO, HARD_POSITIVE_RATIO, HARD_MINING_REFRESH)
+    from hard_mining import HardPairSampler
+
+    with app.app_context():
+        df = room_signatures(room_id)
+        if options['exclude_holdout']:
+            df, holdout_df = holdout_split(df)
+            metadata = {'excludes_holdout': True,
+                        'holdout_signature_ids': [int(signature_id) for signature_id in holdout_df['signature_id']]}
+        else:
+            metadata = {'excludes_holdout': False}
+        n_signers = df['id'].nunique()
+        if n_signers < 2:
+            return {'room_id': room_id, 'status': 'skipped', 'reason': 'fewer than two signers with signatures',
+                    'excludes_holdout': metadata['excludes_holdout']}
+
+        start = time.perf_counter()
+        batch_size = int(np.ceil(n_signers*0.75))
+        n_iter = TRAIN_ITER_PER_SIGNER*batch_size
+        model, _ = load_room_model(room_id)
+        if HARD_MINING:
+            sampler = HardPairSampler(df, img_pre, hard_negative_ratio=HARD_NEGATIVE_RATIO,
+                                      hard_positive_ratio=HARD_POSITIVE_RATIO, refresh_every=HARD_MINING_REFRESH)
+        else:
+            sampler = HardPairSampler(df, img_pre, hard_negative_ratio=0, hard_positive_ratio=0)
+        for i in range(1, n_iter+1):
+            inputs, targets = sampler.get_batch(batch_size, model)
+            loss = model.train_on_batch(inputs, targets)
+
+        version = publish_model(str(room_id), model, metadata)
+        cursor = mysql.connection.cursor()
+        cursor.execute('UPDATE models SET model_name = %s, train_status = %s WHERE room_id = %s',
+                       (f"model_room_{room_id}", 'trained', room_id))
+        mysql.connection.commit()
+        elapsed = time.perf_counter() - start
+        return {'room_id': room_id, 'status': 'trained', 'version': version['version'], 'sha256': version['sha256'],
+                'iterations': n_iter, 'batch_size': batch_size, 'final_loss': float(loss), 'seconds': elapsed,
+                'excludes_holdout': metadata['excludes_holdout']}
+
+
+def evaluate_room(room_id, options):
+    from app import app, img_pre, model_registry, VERIFICATION_THRESHOLD
+
+    with app.app_context():
+        version = model_registry.latest(str(room_id))
+        ids = holdout_ids(version)
+        df = room_signatures(room_id)
+        if ids is not None:
+            # Query with exactly the signatures the weights were trained without (those still stored)
+            is_holdout = df['signature_id'].isin(ids)
+            support_df, query_df = df[~is_holdout].reset_index(drop=True), df[is_holdout].reset_index(drop=True)
+            query_df = query_df[query_df['id'].isin(support_df['id'])].reset_index(drop=True)
+        elif options['allow_in_sample']:
+            print(f"room {room_id}: weights were trained on every signature, metrics are in-sample", file=sys.stderr)
+            support_df, query_df = holdout_split(df)
+        else:
+            return {'room_id': room_id, 'status': 'skipped', 'excludes_holdout': False,
+                    'reason': 'weights were trained on the held-out signatures; retrain with --exclude-holdout'}
+        if query_df.empty or support_df['id'].nunique() < 2:
+            return {'room_id': room_id, 'status': 'skipped', 'excludes_holdout': ids is not None,
+                    'reason': 'not enough signers with two or more signatures'}
+        model, version = load_room_model(room_id, version)
+
+    # Preprocess every image once; pairs are then just index arrays into the two image sets
+    # (decoded directly, so evaluation draws nothing from the seeded rng)
+    support_images = img_pre.imread_batch(list(support_df['signature_image']), keys=list(support_df['content_hash']))
+    query_images = img_pre.imread_batch(list(query_df['signature_image']), keys=list(query_df['content_hash']))
+    signers_id = support_df['id'].unique()
+    signer_rows = {signer_id: np.flatnonzero(support_df['id'].values == signer_id) for signer_id in signers_id}
+    k = min(options['top_k'], len(signers_id))
+
+    left, right = [], []
+    recognition = []
+    verification = []
+    for q, signer_id in enumerate(query_df['id']):
+        # Recognition: the query against one random signature of every signer
+        start = len(left)
+        for other_id in signers_id:
+            left.append(q)
+            right.append(rng.choice(signer_rows[other_id]))
+        recognition.append((q, signer_id, start))
+        # Verification: genuine claim, then impostor claims against other signers
+        others = [other_id for other_id in signers_id if other_id != signer_id]
+        impostors = rng.choice(others, size=min(options['impostors'], len(others)), replace=False)
+        for claimed_id in [signer_id, *impostors]:
+            start = len(left)
+            for row in signer_rows[claimed_id]:
+                left.append(q)
+                right.append(row)
+            verification.append((claimed_id == signer_id, start, len(left)))
+
+    start = time.perf_counter()
+    scores = model.predict([query_images[left], support_images[right]], batch_size=256, verbose=0).reshape(-1)
+    elapsed = time.perf_counter() - start
+
+    top1 = topk = 0
+    n_signers = len(signers_id)
+    for q, signer_id, start in recognition:
+        ranking = signers_id[np.argsort(scores[start:start + n_signers])]
+        top1 += ranking[0] == signer_id
+        topk += signer_id in ranking[:k]
+
+    false_accepts = false_rejects = genuine = impostor = 0
+    for is_genuine, start, end in verification:
+        votes = (scores[start:end] < VERIFICATION_THRESHOLD).astype(int)
+        # Ties go to 0, like Series.mode().values[0] in predict_verification
+        accepted = votes.sum() * 2 > len(votes)
+        if is_genuine:
+            genuine += 1
+            false_rejects += not accepted
+        else:
+            impostor += 1
+            false_accepts += accepted
+
+    n_queries = len(query_df)
+    return {
+        'room_id': room_id,
+        'status': 'evaluated',
+        'model_version': version['version'] if version else None,
+        'excludes_holdout': ids is not None,
+        'in_sample': ids is None,
+        'signers': int(n_signers),
+        'queries': n_queries,
+        'recognition': {'top1': top1 / n_queries, f'top{k}': topk / n_queries, 'k': k},
+        'verification': {'threshold': VERIFICATION_THRESHOLD, 'far': false_accepts / impostor if impostor else None,
+                         'frr': false_rejects / genuine, 'genuine_claims': genuine, 'impostor_claims': impostor},
+        'throughput': {'pairs': len(left), 'seconds': elapsed, 'pairs_per_second': len(left) / elapsed},
+    }
+
+
+def run_jobs(job, room_ids, options, jobs, threads, seed):
+    # spawn: each job gets a fresh TensorFlow runtime and img_pre with its own thread budget
+    results = []
+    context = multiprocessing.get_context('spawn')
+    with ProcessPoolExecutor(max_workers=jobs, mp_context=context,
+                             initializer=set_thread_budget, initargs=(threads, seed)) as executor:
+        futures = {executor.submit(job, room_id, options): room_id for room_id in room_ids}
+        for future in as_completed(futures):
+            room_id = futures[future]
+            try:
+                result = future.result()
+            except Exception as e:
+                result = {'room_id': room_id, 'status': 'failed', 'error': repr(e)}
+            reason = f" ({result['reason']})" if 'reason' in result else ''
+            print(f"room {room_id}: {result['status']}{reason}", file=sys.stderr)
+            results.append(result)
+    return sorted(results, key=lambda result: result['room_id'])
+
+
+def regressions(report, baseline, tolerance):
+    found = []
+    # In-sample numbers measure memorisation, not quality: never compare them
+    def comparable(room):
+        return room['status'] == 'evaluated' and not room.get('in_sample', True)
+
+    previous = {room['room_id']: room for room in baseline.get('evaluation', []) if comparable(room)}
+    for room in report.get('evaluation', []):
+        old = previous.get(room['room_id'])
+        if not comparable(room) or old is None:
+            continue
+        checks = [
+            ('top1', room['recognition']['top1'], old['recognition']['top1'], -1),
+            ('far', room['verification']['far'], old['verification']['far'], 1),
+            ('frr', room['verification']['frr'], old['verification']['frr'], 1),
+        ]
+        for name, new_value, old_value, worse in checks:
+            if new_value is not None and old_value is not None and (new_value - old_value) * worse > tolerance:
+                found.append({'room_id': room['room_id'], 'metric': name, 'baseline': old_value, 'current': new_value})
+        new_rate = room['throughput']['pairs_per_second']
+        old_rate = old['throughput']['pairs_per_second']
+        if new_rate < old_rate * (1 - tolerance):
+            found.append({'room_id': room['room_id'], 'metric': 'pairs_per_second', 'baseline': old_rate, 'current': new_rate})
+    return found
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    for name in ('train', 'evaluate'):
+        sub = subparsers.add_parser(name)
+        sub.add_argument('--rooms', type=int, nargs='+',
+                         help='room ids (default: untrained rooms for train, all rooms for evaluate)')
+        sub.add_argument('--jobs', type=int, default=1, help='rooms processed in parallel')
+        sub.add_argument('--threads', type=int, default=2, help='TensorFlow intra-/inter-op and image decoding threads per job')
+        sub.add_argument('--seed', type=int, default=0)
+        sub.add_argument('--report', help='write the JSON report here instead of stdout')
+        sub.add_argument('--top-k', type=int, default=3)
+        sub.add_argument('--impostors', type=int, default=5, help='impostor claims per held-out signature')
+        sub.add_argument('--baseline', help='earlier report to compare the evaluation against')
+        sub.add_argument('--tolerance', type=float, default=0.05)
+        sub.add_argument('--allow-in-sample', action='store_true',
+                         help='evaluate rooms whose weights saw every signature (flagged in_sample, not compared)')
+        if name == 'train':
+            sub.add_argument('--exclude-holdout', action='store_true',
+                             help='train without the signatures evaluate holds out')
+            sub.add_argument('--evaluate', action='store_true',
+                             help='evaluate the rooms after training (implies --exclude-holdout)')
+    args = parser.parse_args()
+
+    from app import app
+    with app.app_context():
+        default_rooms = untrained_rooms() if args.command == 'train' else all_rooms()
+    room_ids = args.rooms or default_rooms
+    options = {'exclude_holdout': getattr(args, 'exclude_holdout', False) or getattr(args, 'evaluate', False),
+               'allow_in_sample': args.allow_in_sample, 'top_k': args.top_k, 'impostors': args.impostors}
+
+    report = {'generated_at': datetime.now(timezone.utc).isoformat(), 'command': args.command, 'rooms': room_ids,
+              'jobs': args.jobs, 'threads_per_job': args.threads}
+    if args.command == 'train':
+        report['training'] = run_jobs(train_room, room_ids, options, args.jobs, args.threads, args.seed)
+    if args.command == 'evaluate' or getattr(args, 'evaluate', False):
+        report['evaluation'] = run_jobs(evaluate_room, room_ids, options, args.jobs, args.threads, args.seed)
+
+    found = []
+    if args.baseline:
+        with open(args.baseline) as f:
+            found = regressions(report, json.load(f), args.tolerance)
+        report['regressions'] = found
+
+    output = json.dumps(report, indent=2, default=str)
+    if args.report:
+        with open(args.report, 'w') as f:
+            f.write(output)
+    else:
+        print(output)
+    failed = any(result['status'] == 'failed' for key in ('training', 'evaluation') for result in report.get(key, []))
+    sys.exit(1 if found or failed else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,125 @@
+"""Iterations and wall-clock time to a target validation loss: uniform vs hard pair sampling.
+
+Usage: python bench_hard_mining.py <room_id> [--target-loss 0.1] [--max-iter N]
+                                   [--eval-every 10] [--seed 0] [--output report.json]
+
+Fetches the room's signatures from the running app (HOST_URL), holds out
+about a quarter of each signer's images for a fixed set of validation pairs,
+then trains from the room's current weights once per sampler. For each
+sampler it records the first iteration at which the validation contrastive
+loss reaches the target, and the training wall-clock time up to that point.
+That time includes the hard sampler's refresh() scoring, which grows with
+the square of the number of signers, but not the validation evaluations.
+It also records how many pairs the sampler scored to mine batches.
+"""
+import argparse
+import json
+import time
+
+import numpy as np
+import numpy.random as rng
+import pandas as pd
+import requests
+
+from app import my_url, img_pre, get_model, contrastive_loss, HARD_MINING_REFRESH, TRAIN_ITER_PER_SIGNER
+from hard_mining import HardPairSampler
+
+
+def split_rows(df, val_fraction=0.25):
+    train_rows, val_rows = [], []
+    for _, rows in df.groupby('id').groups.items():
+        rows = rng.permutation(list(rows))
+        n_val = int(len(rows) * val_fraction) if len(rows) > 1 else 0
+        val_rows.extend(rows[:n_val])
+        train_rows.extend(rows[n_val:])
+    return df.loc[train_rows].reset_index(drop=True), df.loc[val_rows].reset_index(drop=True)
+
+
+def validation_pairs(train_df, val_df):
+    # Each held-out image against a training image of the same signer and of a random other signer
+    sampler = HardPairSampler(pd.concat([train_df, val_df], ignore_index=True), img_pre)
+    n_train = len(train_df)
+    rows_1, rows_2, targets = [], [], []
+    if train_df['id'].nunique() < 2 or val_df.empty:
+        raise SystemExit('need at least two signers with two or more signatures each')
+    for val_row, signer_id in enumerate(val_df['id']):
+        same = np.flatnonzero(train_df['id'].values == signer_id)
+        other = np.flatnonzero(train_df['id'].values != signer_id)
+        rows_1 += [n_train + val_row, n_train + val_row]
+        rows_2 += [rng.choice(same), rng.choice(other)]
+        targets += [1, 0]
+    images = sampler.read_rows(rows_1 + rows_2)
+    n_pairs = len(targets)
+    return [images[:n_pairs], images[n_pairs:]], np.asarray(targets, dtype='float32')
+
+
+def validation_loss(model, pairs, targets):
+    scores = model.predict(pairs, batch_size=256, verbose=0).reshape(-1)
+    return float(contrastive_loss(targets, scores))
+
+
+def run(name, sampler, room_id, batch_size, val_pairs, val_targets, args):
+    model = get_model(room_id, cached=False)
+    curve = []
+    reached = None
+    seconds_to_target = None
+    train_seconds = 0.0
+    for i in range(1, args.max_iter + 1):
+        start = time.perf_counter()
+        inputs, targets = sampler.get_batch(batch_size, model)
+        model.train_on_batch(inputs, targets)
+        train_seconds += time.perf_counter() - start
+        if i % args.eval_every == 0:
+            loss = validation_loss(model, val_pairs, val_targets)
+            curve.append((i, train_seconds, loss))
+            if loss <= args.target_loss:
+                reached = i
+                seconds_to_target = train_seconds
+                break
+    print(f"{name:<8} to {args.target_loss}: "
+          f"{f'{reached} iterations, {seconds_to_target:.1f}s' if reached else 'not reached'} "
+          f"(trained {train_seconds:.1f}s, {sampler.pairs_scored} pairs scored for mining in {sampler.refresh_seconds:.1f}s)")
+    return {'iterations_to_target': reached, 'seconds_to_target': seconds_to_target,
+            'mining_pairs_scored': sampler.pairs_scored, 'mining_seconds': sampler.refresh_seconds,
+            'train_seconds': train_seconds, 'curve': curve}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('room_id')
+    parser.add_argument('--target-loss', type=float, default=0.1)
+    parser.add_argument('--max-iter', type=int, default=None, help='default: TRAIN_ITER_PER_SIGNER * batch_size, as in trainmodel')
+    parser.add_argument('--eval-every', type=int, default=10)
+    parser.add_argument('--hard-negative-ratio', type=float, default=0.5)
+    parser.add_argument('--hard-positive-ratio', type=float, default=0.5)
+    parser.add_argument('--refresh-every', type=int, default=HARD_MINING_REFRESH)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output')
+    args = parser.parse_args()
+
+    rng.seed(args.seed)
+    df = pd.DataFrame(requests.get(f"{my_url}/api/signatures/room/{args.room_id}").json())
+    train_df, val_df = split_rows(df)
+    val_pairs, val_targets = validation_pairs(train_df, val_df)
+    n_signers = train_df['id'].nunique()
+    batch_size = int(np.ceil(n_signers * 0.75))
+    args.max_iter = args.max_iter or TRAIN_ITER_PER_SIGNER * batch_size
+
+    samplers = {
+        'uniform': HardPairSampler(train_df, img_pre, hard_negative_ratio=0, hard_positive_ratio=0),
+        'hard': HardPairSampler(train_df, img_pre, hard_negative_ratio=args.hard_negative_ratio,
+                                hard_positive_ratio=args.hard_positive_ratio, refresh_every=args.refresh_every),
+    }
+    report = {'room_id': args.room_id, 'target_loss': args.target_loss, 'batch_size': batch_size,
+              'max_iter': args.max_iter, 'validation_pairs': len(val_targets)}
+    for name, sampler in samplers.items():
+        rng.seed(args.seed)
+        report[name] = run(name, sampler, args.room_id, batch_size, val_pairs, val_targets, args)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
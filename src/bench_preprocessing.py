@@ -0,0 +1,74 @@
+"""Throughput of signature preprocessing: per-image imread vs imread_batch.
+
+Usage: python bench_preprocessing.py [n_images] [repeats]
+
+Synthesizes scan-sized JPEG and PNG signatures in memory, then reports
+images/second for the old path (decode one image at a time, copy into a
+float64 batch like get_batch used to) and the batched, threaded path.
+"""
+import io
+import os
+import sys
+import time
+
+# app.py reads its configuration from the environment at import time
+os.environ.setdefault('DATABASE_PORT', '3306')
+os.environ.setdefault('APP_DIR', os.path.dirname(os.path.abspath(__file__)))
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+from app import img_pre
+
+
+def make_signature(seed, size=(1700, 1200), format='JPEG'):
+    rnd = np.random.RandomState(seed)
+    image = Image.new('RGB', size, 'white')
+    draw = ImageDraw.Draw(image)
+    points = [tuple(p) for p in rnd.randint(0, min(size), size=(40, 2))]
+    draw.line(points, fill='black', width=6)
+    buf = io.BytesIO()
+    image.save(buf, format=format, quality=90)
+    return buf.getvalue()
+
+
+def old_path(buffers):
+    batch = np.zeros((len(buffers), img_pre.img_height, img_pre.img_width, 1))
+    for i, data in enumerate(buffers):
+        image = Image.open(io.BytesIO(data))
+        batch[i, :, :, :] = img_pre.processing(image)
+    return batch
+
+
+def new_path(buffers, out):
+    return img_pre.imread_batch(buffers, out)
+
+
+def bench(name, fn, buffers, repeats):
+    fn(buffers)  # warm-up
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn(buffers)
+    elapsed = time.perf_counter() - start
+    rate = len(buffers) * repeats / elapsed
+    print(f"{name:<28} {rate:10.1f} images/s")
+    return rate
+
+
+def main():
+    n_images = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    repeats = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+    out = np.empty((n_images, img_pre.img_height, img_pre.img_width, 1), dtype='float32')
+
+    for format in ('JPEG', 'PNG'):
+        buffers = [make_signature(i, format=format) for i in range(n_images)]
+        print(f"{format}: {n_images} images, {repeats} repeats, {img_pre.n_workers} workers")
+        old_rate = bench('imread (one at a time)', old_path, buffers, repeats)
+        new_rate = bench('imread_batch (threaded)', lambda b: new_path(b, out), buffers, repeats)
+        print(f"{'speed-up':<28} {new_rate / old_rate:10.2f}x")
+        diff = np.abs(old_path(buffers[:8]) - new_path(buffers[:8], out[:8])).max()
+        print(f"{'max abs diff vs old path':<28} {diff:10.4f}\n")
+
+
+if __name__ == "__main__":
+    main()
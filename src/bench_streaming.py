@@ -0,0 +1,79 @@
+"""Peak memory of the room signature listing: buffered vs streaming.
+
+Usage: python bench_streaming.py <room_id> [--sizes 50 100 200 400 800]
+
+For each size, serves /api/signatures/room/<room_id>?limit=<size> once with
+the old buffered implementation (fetchall, list of base64 strings, jsonify)
+and once with the streaming endpoint, each in a fresh process, and reports
+the peak Python heap (tracemalloc) and the growth in peak RSS while the
+response body is produced and consumed. Use a room holding at least the
+largest size in signatures.
+"""
+import argparse
+import json
+import resource
+import subprocess
+import sys
+import tracemalloc
+
+
+def buffered_response(mysql, room_id, limit):
+    import MySQLdb.cursors
+    from base64 import b64encode
+    from flask import jsonify, make_response
+
+    cursor = mysql.connection.cursor(MySQLdb.cursors.DictCursor)
+    cursor.execute("""SELECT signature_image, id, content_hash
+    FROM signatures AS sig, accounts AS a, join_rooms AS jr, rooms AS r
+    WHERE sig.account_id = a.id AND a.id = jr.account_id AND jr.room_id = r.room_id AND r.room_id = %s
+    ORDER BY sig.signature_id LIMIT %s""", (room_id, limit))
+    signatures = cursor.fetchall()
+    data = []
+    for row in signatures:
+        image = b64encode(row['signature_image']).decode('utf-8')
+        data.append({'signature_image' : image, 'id' : row['id'], 'content_hash' : row['content_hash']})
+    return make_response(jsonify(data), 200)
+
+
+def child(mode, room_id, size):
+    from app import app, mysql, take_signatures_by_room
+
+    path = f"/api/signatures/room/{room_id}?limit={size}"
+    with app.test_request_context(path):
+        rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        tracemalloc.start()
+        if mode == 'buffered':
+            response = buffered_response(mysql, room_id, size)
+        else:
+            response = take_signatures_by_room(room_id)
+        n_bytes = sum(len(chunk) for chunk in response.response)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in KiB on Linux
+    print(json.dumps({'mode': mode, 'size': size, 'body_mb': n_bytes / 2**20,
+                      'heap_peak_mb': peak / 2**20, 'rss_growth_mb': (rss_after - rss_before) / 1024}))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('room_id')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[50, 100, 200, 400, 800])
+    parser.add_argument('--child', nargs=2, metavar=('MODE', 'SIZE'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.child:
+        child(args.child[0], args.room_id, int(args.child[1]))
+        return
+
+    print(f"{'mode':<10} {'rows':>6} {'body MB':>9} {'heap peak MB':>13} {'RSS growth MB':>14}")
+    for size in args.sizes:
+        for mode in ('buffered', 'streaming'):
+            output = subprocess.run([sys.executable, __file__, args.room_id, '--child', mode, str(size)],
+                                    check=True, capture_output=True, text=True).stdout
+            result = json.loads(output.strip().splitlines()[-1])
+            print(f"{mode:<10} {size:>6} {result['body_mb']:>9.1f} {result['heap_peak_mb']:>13.1f} {result['rss_growth_mb']:>14.1f}")
+
+
+if __name__ == "__main__":
+    main()
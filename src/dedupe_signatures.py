@@ -0,0 +1,122 @@
+"""Backfill signature content hashes and remove duplicate uploads.
+
+Usage: python dedupe_signatures.py [--near-distance N] [--dry-run]
+
+Adds the content_hash / perceptual_hash columns to the signatures table if
+they are missing (migrations/001_signature_hashes.sql, which the app also
+applies on its first request), hashes every row that has none yet, then
+keeps only the oldest signature of each group of duplicates per account. With
+--near-distance, signatures whose perceptual hashes differ by at most N bits
+are treated as duplicates too. Finally (account_id, content_hash) is made a
+UNIQUE index, so concurrent uploads of the same file cannot both be stored.
+
+--dry-run writes nothing: missing hashes are computed in memory and the
+script only reports what it would add, hash and delete.
+"""
+import argparse
+
+import MySQLdb.cursors
+
+from app import (app, mysql, content_hash, perceptual_hash, hamming_distance,
+                 has_signature_hash_columns, add_signature_hash_columns)
+
+
+def has_unique_index(cursor):
+    cursor.execute("SHOW INDEX FROM signatures WHERE Key_name = 'uq_signatures_account_hash'")
+    return bool(cursor.fetchall())
+
+
+def add_unique_index(cursor):
+    # Replaces the non-unique index created by earlier versions of this script
+    cursor.execute("SHOW INDEX FROM signatures WHERE Key_name = 'idx_signatures_account_hash'")
+    if cursor.fetchall():
+        cursor.execute('ALTER TABLE signatures DROP INDEX idx_signatures_account_hash')
+    cursor.execute('ALTER TABLE signatures ADD UNIQUE INDEX uq_signatures_account_hash (account_id, content_hash)')
+
+
+def load_hashes(cursor, columns_exist):
+    # signature_id -> {account_id, content_hash, perceptual_hash}; stored hashes where there are any
+    if columns_exist:
+        cursor.execute('SELECT signature_id, account_id, content_hash, perceptual_hash FROM signatures')
+    else:
+        cursor.execute('SELECT signature_id, account_id, NULL AS content_hash, NULL AS perceptual_hash FROM signatures')
+    return {row['signature_id']: row for row in cursor.fetchall()}
+
+
+def backfill_hashes(cursor, hashes, dry_run, batch_size=100):
+    # Blobs are fetched one at a time so the whole table is never held in memory
+    missing = [signature_id for signature_id, row in hashes.items() if row['content_hash'] is None]
+    for n, signature_id in enumerate(missing, 1):
+        cursor.execute('SELECT signature_image FROM signatures WHERE signature_id = %s', (signature_id,))
+        image = cursor.fetchone()['signature_image']
+        row = hashes[signature_id]
+        row['content_hash'] = content_hash(image)
+        row['perceptual_hash'] = perceptual_hash(image)
+        if dry_run:
+            continue
+        cursor.execute('UPDATE signatures SET content_hash = %s, perceptual_hash = %s WHERE signature_id = %s',
+                       (row['content_hash'], row['perceptual_hash'], signature_id))
+        if n % batch_size == 0:
+            mysql.connection.commit()
+    if not dry_run:
+        mysql.connection.commit()
+    return len(missing)
+
+
+def find_duplicates(hashes, near_distance=0):
+    # Return the signature_ids to drop: every signature that duplicates an older one of the same account
+    kept = {}
+    duplicates = []
+    for row in sorted(hashes.values(), key=lambda row: (row['account_id'], row['signature_id'])):
+        account_kept = kept.setdefault(row['account_id'], [])
+        is_duplicate = False
+        for other in account_kept:
+            if row['content_hash'] == other['content_hash']:
+                is_duplicate = True
+            elif near_distance and row['perceptual_hash'] is not None and other['perceptual_hash'] is not None:
+                is_duplicate = hamming_distance(row['perceptual_hash'], other['perceptual_hash']) <= near_distance
+            if is_duplicate:
+                break
+        if is_duplicate:
+            duplicates.append(row['signature_id'])
+        else:
+            account_kept.append(row)
+    return duplicates
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--near-distance', type=int, default=0,
+                        help='also drop signatures within this many perceptual-hash bits of an older one')
+    parser.add_argument('--dry-run', action='store_true', help='report what would change without writing anything')
+    args = parser.parse_args()
+
+    with app.app_context():
+        cursor = mysql.connection.cursor(MySQLdb.cursors.DictCursor)
+        columns_exist = has_signature_hash_columns(cursor)
+        hashes = load_hashes(cursor, columns_exist)
+        if not columns_exist:
+            if not args.dry_run:
+                add_signature_hash_columns(cursor)
+            print(f"{'Would add' if args.dry_run else 'Added'} content_hash/perceptual_hash columns")
+        n_hashed = backfill_hashes(cursor, hashes, args.dry_run)
+        print(f"{'Would hash' if args.dry_run else 'Hashed'} {n_hashed} signatures")
+
+        duplicates = find_duplicates(hashes, args.near_distance)
+        print(f'Found {len(duplicates)} duplicate signatures')
+        if duplicates and not args.dry_run:
+            for signature_id in duplicates:
+                cursor.execute('DELETE FROM signatures WHERE signature_id = %s', (signature_id,))
+            mysql.connection.commit()
+        if duplicates:
+            print(f"{'Would delete' if args.dry_run else 'Deleted'} {len(duplicates)} duplicate signatures")
+
+        # Only possible once no exact duplicates are left
+        if not columns_exist or not has_unique_index(cursor):
+            if not args.dry_run:
+                add_unique_index(cursor)
+            print(f"{'Would add' if args.dry_run else 'Added'} unique index on (account_id, content_hash)")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,2 +1,7 @@
 bind = "0.0.0.0:8080"
-workers = 2
\ No newline at end of file
+workers = 2
+# Threads per worker. The admission limits in app.py cap the model routes below
+# this, and the threads left over serve pages and the internal /api calls.
+# Keep it above the sum of the heavy classes' slots and queues.
+worker_class = "gthread"
+threads = 16
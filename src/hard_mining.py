@@ -0,0 +1,139 @@
+"""Hard pair mining for siamese training.
+
+HardPairSampler builds the same half negative / half positive batches as
+app.get_batch, but every ``refresh_every`` batches it scores pairs with the
+model being trained and keeps a table of signer-to-signer distances plus
+the hardest genuine pair of each signer. A fraction of the negatives then
+pairs a signer with the signers it is most often confused with, and a
+fraction of the positives uses that signer's least similar genuine pair.
+With both ratios at 0 it is the uniform sampler of get_batch.
+"""
+import time
+from base64 import b64decode
+
+import numpy as np
+import numpy.random as rng
+
+
+class HardPairSampler:
+    def __init__(self, df, preprocessing, hard_negative_ratio=0.5, hard_positive_ratio=0.5,
+                 refresh_every=10, pool_size=4, temperature=0.1, momentum=0.5):
+        self.df = df.reset_index(drop=True)
+        self.preprocessing = preprocessing
+        self.hard_negative_ratio = hard_negative_ratio
+        self.hard_positive_ratio = hard_positive_ratio
+        self.refresh_every = refresh_every
+        self.temperature = temperature
+        self.momentum = momentum
+
+        self.signers_id = self.df['id'].unique()
+        self.n_signers = len(self.signers_id)
+        ids = self.df['id'].values
+        self.rows = [np.flatnonzero(ids == signer_id) for signer_id in self.signers_id]
+        # A few images per signer are preprocessed once and used to score pairs on every refresh
+        self.pool = [rng.choice(rows, size=min(pool_size, len(rows)), replace=False) for rows in self.rows]
+        self.pool_start = np.cumsum([0] + [len(pool) for pool in self.pool])
+        self.pool_images = None
+
+        # signer_distances[a, b]: smoothed model distance between signers a and b (inf on the diagonal)
+        self.signer_distances = None
+        # hardest_positive[a]: (row, row) of signer a's least similar genuine pair, or None
+        self.hardest_positive = [None] * self.n_signers
+        self.iteration = 0
+        # Mining cost: refresh() scores O(n_signers^2) pairs
+        self.pairs_scored = 0
+        self.refresh_seconds = 0.0
+
+    def read_rows(self, rows):
+        # signature_image holds raw bytes (read straight from the database) or
+        # base64 text (from the /api/signatures JSON)
+        buffers = [image if isinstance(image, bytes) else b64decode(image)
+                   for image in (self.df.at[row, 'signature_image'] for row in rows)]
+        keys = list(self.df.loc[rows, 'content_hash']) if 'content_hash' in self.df else None
+        return self.preprocessing.imread_batch(buffers, keys=keys)
+
+    def refresh(self, model, batch_size=256):
+        if self.pool_images is None:
+            self.pool_images = self.read_rows(np.concatenate(self.pool))
+        n = self.n_signers
+
+        # One random pool image per signer on each side of every signer pair
+        left, right, pair_signers = [], [], []
+        for a in range(n):
+            for b in range(a + 1, n):
+                left.append(self.pool_start[a] + rng.randint(len(self.pool[a])))
+                right.append(self.pool_start[b] + rng.randint(len(self.pool[b])))
+                pair_signers.append((a, b))
+        # Every genuine pair inside each signer's pool
+        positive_pairs = []
+        for a in range(n):
+            for i in range(len(self.pool[a])):
+                for j in range(i + 1, len(self.pool[a])):
+                    left.append(self.pool_start[a] + i)
+                    right.append(self.pool_start[a] + j)
+                    positive_pairs.append((a, i, j))
+        if not left:
+            return
+
+        start = time.perf_counter()
+        scores = model.predict([self.pool_images[left], self.pool_images[right]], batch_size=batch_size, verbose=0)
+        scores = np.asarray(scores).reshape(-1)
+        self.pairs_scored += len(left)
+        self.refresh_seconds += time.perf_counter() - start
+
+        distances = np.full((n, n), np.inf)
+        for (a, b), score in zip(pair_signers, scores):
+            distances[a, b] = distances[b, a] = score
+        if self.signer_distances is None:
+            self.signer_distances = distances
+        else:
+            self.signer_distances = self.momentum * self.signer_distances + (1 - self.momentum) * distances
+
+        hardest_scores = [-np.inf] * n
+        self.hardest_positive = [None] * n
+        for (a, i, j), score in zip(positive_pairs, scores[len(pair_signers):]):
+            if score > hardest_scores[a]:
+                hardest_scores[a] = score
+                self.hardest_positive[a] = (self.pool[a][i], self.pool[a][j])
+
+    def confusable_signer(self, category):
+        # Closer signers are exponentially more likely to be picked
+        distances = self.signer_distances[category]
+        weights = np.exp(-(distances - distances.min()) / self.temperature)
+        return rng.choice(self.n_signers, p=weights / weights.sum())
+
+    def get_batch(self, batch_size, model=None):
+        if model is not None and self.iteration % self.refresh_every == 0 and (self.hard_negative_ratio or self.hard_positive_ratio):
+            self.refresh(model)
+        self.iteration += 1
+        mined = self.signer_distances is not None
+        n_signers = self.n_signers
+
+        #randomly sample several classes to use in the batch
+        categories = rng.choice(n_signers, size=(batch_size,), replace=False)
+
+        #make one half of the targets '1's, so 2nd half of batch has same class
+        targets = np.zeros((batch_size,))
+        targets[batch_size//2:] = 1
+
+        rows_1 = [None] * batch_size
+        rows_2 = [None] * batch_size
+        for i in range(batch_size):
+            category_1 = categories[i]
+            if i >= batch_size // 2:
+                if mined and self.hardest_positive[category_1] is not None and rng.rand() < self.hard_positive_ratio:
+                    rows_1[i], rows_2[i] = self.hardest_positive[category_1]
+                else:
+                    rows_1[i] = rng.choice(self.rows[category_1])
+                    rows_2[i] = rng.choice(self.rows[category_1])
+            else:
+                if mined and rng.rand() < self.hard_negative_ratio:
+                    category_2 = self.confusable_signer(category_1)
+                else:
+                    category_2 = (category_1 + rng.randint(1, n_signers)) % n_signers
+                rows_1[i] = rng.choice(self.rows[category_1])
+                rows_2[i] = rng.choice(self.rows[category_2])
+
+        images = self.read_rows(rows_1 + rows_2)
+        pairs = [images[:batch_size], images[batch_size:]]
+        return pairs, targets
@@ -0,0 +1,9 @@
+-- Content and perceptual hashes of stored signatures (used for upload deduplication
+-- and as preprocessing cache keys). The app applies this on its first request if
+-- the columns are missing; it can also be run by hand:
+--   mysql <database> < migrations/001_signature_hashes.sql
+-- Existing rows are hashed, and the UNIQUE (account_id, content_hash) index added,
+-- by the separate dedupe_signatures.py step.
+ALTER TABLE signatures
+    ADD COLUMN content_hash CHAR(64) NULL,
+    ADD COLUMN perceptual_hash BIGINT UNSIGNED NULL
@@ -0,0 +1,280 @@
+"""Versioned, content-addressed store for trained room weights.
+
+Weights are stored once per content hash (``blobs/<sha256>.h5``) and each room
+keeps a JSON manifest (``rooms/<room_id>.json``) listing its versions, newest
+last. Storage goes through a small backend interface so the app nodes can
+share one store; ``LocalDirectoryBackend`` works on any directory (a local
+path for development, an NFS/SMB mount when scaled out). Nodes download
+blobs lazily into a local cache directory that is itself keyed by hash, so a
+version is fetched at most once per node.
+"""
+import hashlib
+import json
+import os
+import shutil
+import socket
+import tempfile
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+
+
+class RegistryError(Exception):
+    pass
+
+
+def file_sha256(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def atomic_copy(src_path, dest_path):
+    # Copy to a temp file in the destination directory, then rename over the
+    # target so readers never see a partially written file
+    dest_dir = os.path.dirname(dest_path)
+    os.makedirs(dest_dir, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=dest_dir, prefix='.tmp-')
+    try:
+        with os.fdopen(fd, 'wb') as dst, open(src_path, 'rb') as src:
+            shutil.copyfileobj(src, dst)
+            dst.flush()
+            os.fsync(dst.fileno())
+        os.replace(tmp_path, dest_path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class LocalDirectoryBackend:
+    """Storage backend on a (possibly shared) directory.
+
+    Any other backend (object store, database) only needs the same methods.
+    """
+
+    def __init__(self, root, lock_timeout=30.0):
+        self.root = root
+        self.lock_timeout = lock_timeout
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.root, *key.split('/'))
+
+    def exists(self, key):
+        return os.path.exists(self._path(key))
+
+    def put_file(self, key, src_path):
+        atomic_copy(src_path, self._path(key))
+
+    def get_file(self, key, dest_path):
+        if not self.exists(key):
+            raise RegistryError(f"missing object {key}")
+        atomic_copy(self._path(key), dest_path)
+
+    def read_json(self, key, default=None):
+        try:
+            with open(self._path(key)) as f:
+                return json.load(f)
+        except FileNotFoundError:
+            return default
+
+    def write_json(self, key, value):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+        with os.fdopen(fd, 'w') as f:
+            json.dump(value, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    def list(self, prefix):
+        path = self._path(prefix)
+        if not os.path.isdir(path):
+            return []
+        return [f"{prefix}/{name}" for name in os.listdir(path) if not name.startswith('.')]
+
+    def lock(self, key):
+        return _FileLock(self._path(key) + '.lock', self.lock_timeout)
+
+
+class _FileLock:
+    # O_EXCL lock file; works across processes and across nodes on a shared mount.
+    # The file names its holder (host, pid, token) and the holder touches it
+    # every timeout/4 while it holds it. A lock is only broken when its holder
+    # is gone: a dead pid on this host, or no heartbeat for `timeout` seconds.
+    def __init__(self, path, timeout):
+        self.path = path
+        self.timeout = timeout
+        self.owner = {'host': socket.gethostname(), 'pid': os.getpid(), 'token': uuid.uuid4().hex}
+        self._stop = threading.Event()
+        self._heartbeat = None
+
+    def __enter__(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        deadline = time.monotonic() + self.timeout
+        while True:
+            try:
+                fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                if self._break_if_abandoned():
+                    continue
+                if time.monotonic() > deadline:
+                    raise RegistryError(f"timed out waiting for {self.path}")
+                time.sleep(0.05)
+                continue
+            with os.fdopen(fd, 'w') as f:
+                json.dump(self.owner, f)
+            self._heartbeat = threading.Thread(target=self._touch, daemon=True)
+            self._heartbeat.start()
+            return self
+
+    def _touch(self):
+        while not self._stop.wait(self.timeout / 4):
+            try:
+                os.utime(self.path)
+            except FileNotFoundError:
+                return
+
+    def _read_owner(self, path):
+        try:
+            with open(path) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    def _abandoned(self, owner):
+        try:
+            silent_for = time.time() - os.path.getmtime(self.path)
+        except FileNotFoundError:
+            return False
+        if owner and owner.get('host') == self.owner['host']:
+            try:
+                os.kill(owner['pid'], 0)
+            except ProcessLookupError:
+                return True
+            except PermissionError:
+                pass
+            else:
+                return False
+        # Holder on another node (or not yet identified): it is gone once its heartbeat stops
+        return silent_for > self.timeout
+
+    def _break_if_abandoned(self):
+        owner = self._read_owner(self.path)
+        if not self._abandoned(owner):
+            return False
+        # Move the stale lock aside first, so only one waiter breaks it; if the file
+        # was replaced by a live lock in the meantime, put that one back
+        stale_path = f"{self.path}.stale-{self.owner['token']}"
+        try:
+            os.rename(self.path, stale_path)
+        except FileNotFoundError:
+            return True
+        moved = self._read_owner(stale_path)
+        if owner is not None and moved is not None and moved.get('token') != owner.get('token'):
+            try:
+                os.link(stale_path, self.path)
+            except FileExistsError:
+                pass
+        os.remove(stale_path)
+        return True
+
+    def __exit__(self, *exc):
+        self._stop.set()
+        if self._heartbeat is not None:
+            self._heartbeat.join()
+        # Only remove the lock if it is still ours
+        owner = self._read_owner(self.path)
+        if owner is not None and owner.get('token') == self.owner['token']:
+            try:
+                os.remove(self.path)
+            except FileNotFoundError:
+                pass
+
+
+class ModelRegistry:
+    def __init__(self, backend, cache_dir):
+        self.backend = backend
+        self.cache_dir = cache_dir
+        self._fetch_lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    @staticmethod
+    def _manifest_key(room_id):
+        return f"rooms/{room_id}.json"
+
+    @staticmethod
+    def _blob_key(sha256):
+        return f"blobs/{sha256}.h5"
+
+    def history(self, room_id):
+        return self.backend.read_json(self._manifest_key(room_id), default=[])
+
+    def latest(self, room_id):
+        versions = self.history(room_id)
+        return versions[-1] if versions else None
+
+    def publish(self, room_id, weights_path, metadata=None):
+        """Store weights_path as the newest version of room_id and return it.
+
+        metadata (a JSON-serializable dict) is kept with the version, e.g. which
+        signatures were left out of training.
+        """
+        sha256 = file_sha256(weights_path)
+        blob_key = self._blob_key(sha256)
+        if not self.backend.exists(blob_key):
+            self.backend.put_file(blob_key, weights_path)
+        manifest_key = self._manifest_key(room_id)
+        with self.backend.lock(manifest_key):
+            versions = self.backend.read_json(manifest_key, default=[])
+            if versions and versions[-1]['sha256'] == sha256 and versions[-1].get('metadata') == metadata:
+                return versions[-1]
+            version = {
+                'version': versions[-1]['version'] + 1 if versions else 1,
+                'sha256': sha256,
+                'created_at': datetime.now(timezone.utc).isoformat(),
+            }
+            if metadata is not None:
+                version['metadata'] = metadata
+            versions.append(version)
+            self.backend.write_json(manifest_key, versions)
+        return version
+
+    def fetch(self, version):
+        """Return a local path to the weights of version, downloading on first use."""
+        sha256 = version['sha256']
+        local_path = os.path.join(self.cache_dir, f"{sha256}.h5")
+        if os.path.exists(local_path):
+            return local_path
+        with self._fetch_lock:
+            if not os.path.exists(local_path):
+                self.backend.get_file(self._blob_key(sha256), local_path)
+        return local_path
+
+    def delete_room(self, room_id):
+        """Drop room_id's history and any blobs no other room still references."""
+        manifest_key = self._manifest_key(room_id)
+        with self.backend.lock(manifest_key):
+            versions = self.history(room_id)
+            self.backend.delete(manifest_key)
+        referenced = set()
+        for key in self.backend.list('rooms'):
+            if key.endswith('.json'):
+                referenced.update(v['sha256'] for v in self.backend.read_json(key, default=[]))
+        for version in versions:
+            if version['sha256'] not in referenced:
+                self.backend.delete(self._blob_key(version['sha256']))
+                cached = os.path.join(self.cache_dir, f"{version['sha256']}.h5")
+                if os.path.exists(cached):
+                    os.remove(cached)